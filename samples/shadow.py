@@ -2,13 +2,20 @@
 # SPDX-License-Identifier: Apache-2.0.
 
 import argparse
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import selectors
+import socket
 from awscrt import auth, io, mqtt, http
 from awsiot import iotshadow
 from awsiot import mqtt_connection_builder
-from concurrent.futures import Future
+from concurrent import futures
 import sys
 import threading
-import traceback
+import time
 from uuid import uuid4
 
 # - Overview -
@@ -52,74 +59,127 @@ parser.add_argument('--proxy-port', type=int, default=8080, help="Port for proxy
 parser.add_argument('--verbosity', choices=[x.name for x in io.LogLevel], default=io.LogLevel.NoLogs.name,
     help='Logging level')
 
+# Output is logged through a queue and written to stdout by a background
+# thread, so MQTT callbacks never wait on the stdout lock.
+log_queue = queue.Queue()
+logger = logging.getLogger("shadow")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+# Errors, along with their tracebacks, go to stderr and everything else to stdout
+stdout_handler = logging.StreamHandler(sys.stdout)
+stdout_handler.addFilter(lambda record: record.levelno < logging.ERROR)
+stderr_handler = logging.StreamHandler(sys.stderr)
+stderr_handler.setLevel(logging.ERROR)
+log_listener = logging.handlers.QueueListener(log_queue, stdout_handler, stderr_handler,
+    respect_handler_level=True)
+
 # Using globals to simplify sample code
-is_sample_done = threading.Event()
+connected_event = threading.Event()
+connection_error = [None]
 
 mqtt_connection = None
 shadow_client = None
 thing_name = ""
 shadow_property = ""
 
-SHADOW_VALUE_DEFAULT = "off"
+SHADOW_VALUE_DEFAULT = sys.intern("off")
+
+# Send a PINGREQ after this many idle seconds. Long enough that an idle
+# device rarely wakes up, short enough that a dead connection is noticed
+# and resumed quickly.
+KEEP_ALIVE_SECS = 60
+
+# User input that quits the sample
+QUIT_COMMANDS = frozenset(['exit', 'quit'])
+
+# Changes arriving within this window are coalesced into a single update,
+# so a burst of input lines or delta events results in one publish.
+UPDATE_COALESCE_SECS = 0.03
 
 class LockedData:
     def __init__(self):
         self.lock = threading.Lock()
-        self.shadow_value = None
-        self.disconnect_called = False
+        self.exit_requested = False
 
 locked_data = LockedData()
 
+# Every change to the local shadow value, from MQTT callbacks or user input,
+# is put on this queue as a (source, value, is_initial_query) tuple.
+# flush_shadow_updates() also puts a ("flush", event, False) tuple on it.
+# A single writer thread owns the value and applies changes in order,
+# so no lock is needed around it.
+# SimpleQueue is lighter, but only exists on Python 3.7+.
+shadow_updates = queue.SimpleQueue() if hasattr(queue, 'SimpleQueue') else queue.Queue()
+
+# exit() sends a byte on this socket to wake the main thread's event loop
+wake_socket = None
+
+# Bytes of a partially typed line, read from stdin but not yet handled
+user_input_buffer = [b""]
+
+# The update topic and the JSON around the property's value never change,
+# so they're encoded once at startup. Each publish only encodes the value.
+update_topic = ""
+update_payload_prefix = b""
+update_payload_desired_infix = b""
+update_payload_suffix = b""
+
 # Function for gracefully quitting this sample
 def exit(msg_or_exception):
     if isinstance(msg_or_exception, Exception):
-        print("Exiting sample due to exception.")
-        traceback.print_exception(msg_or_exception.__class__, msg_or_exception, sys.exc_info()[2])
+        logger.error("Exiting sample due to exception.",
+            exc_info=(msg_or_exception.__class__, msg_or_exception, sys.exc_info()[2]))
     else:
-        print("Exiting sample:", msg_or_exception)
+        logger.info("Exiting sample: %s", msg_or_exception)
 
+    # The main thread publishes any change still waiting in the coalescing
+    # window, then disconnects
     with locked_data.lock:
-        if not locked_data.disconnect_called:
-            print("Disconnecting...")
-            locked_data.disconnect_called = True
-            future = mqtt_connection.disconnect()
-            future.add_done_callback(on_disconnected)
+        if not locked_data.exit_requested:
+            locked_data.exit_requested = True
+            if wake_socket:
+                wake_socket.send(b"\0")
+
+# Callback when connection is accidentally lost.
+def on_connection_interrupted(connection, error, **kwargs):
+    logger.info("Connection interrupted. error: %s", error)
 
-def on_disconnected(disconnect_future):
-    # type: (Future) -> None
-    print("Disconnected.")
+# Callback when an interrupted connection is re-established.
+def on_connection_resumed(connection, return_code, session_present, **kwargs):
+    logger.info("Connection resumed. return_code: %s session_present: %s", return_code, session_present)
 
-    # Signal that sample is finished
-    is_sample_done.set()
+def on_connected(connect_future):
+    # type: (futures.Future) -> None
+    connection_error[0] = connect_future.exception()
 
+    # Signal that the connection attempt is finished
+    connected_event.set()
 
 def on_get_shadow_accepted(response):
     # type: (iotshadow.GetShadowResponse) -> None
+    # Bind the property name to a local once, rather than a global lookup per use
+    prop = shadow_property
     try:
-        print("Finished getting initial shadow state.")
-
-        with locked_data.lock:
-            if locked_data.shadow_value is not None:
-                print("  Ignoring initial query because a delta event has already been received.")
-                return
+        logger.info("Finished getting initial shadow state.")
 
         if response.state:
             if response.state.delta:
-                value = response.state.delta.get(shadow_property)
+                value = response.state.delta.get(prop)
                 if value:
-                    print("  Shadow contains delta value '{}'.".format(value))
-                    change_shadow_value(value)
+                    logger.info("  Shadow contains delta value '%s'.", value)
+                    change_shadow_value("delta", value, is_initial_query=True)
                     return
 
             if response.state.reported:
-                value = response.state.reported.get(shadow_property)
+                value = response.state.reported.get(prop)
                 if value:
-                    print("  Shadow contains reported value '{}'.".format(value))
-                    set_local_value_due_to_initial_query(response.state.reported[shadow_property])
+                    logger.info("  Shadow contains reported value '%s'.", value)
+                    change_shadow_value("reported", value, is_initial_query=True)
                     return
 
-        print("  Shadow document lacks '{}' property. Setting defaults...".format(shadow_property))
-        change_shadow_value(SHADOW_VALUE_DEFAULT)
+        logger.info("  Shadow document lacks '%s' property. Setting defaults...", prop)
+        change_shadow_value("default", SHADOW_VALUE_DEFAULT, is_initial_query=True)
         return
 
     except Exception as e:
@@ -128,95 +188,185 @@ def on_get_shadow_accepted(response):
 def on_get_shadow_rejected(error):
     # type: (iotshadow.ErrorResponse) -> None
     if error.code == 404:
-        print("Thing has no shadow document. Creating with defaults...")
-        change_shadow_value(SHADOW_VALUE_DEFAULT)
+        logger.info("Thing has no shadow document. Creating with defaults...")
+        change_shadow_value("default", SHADOW_VALUE_DEFAULT)
     else:
-        exit("Get request was rejected. code:{} message:'{}'".format(
-            error.code, error.message))
+        exit(f"Get request was rejected. code:{error.code} message:'{error.message}'")
 
 def on_shadow_delta_updated(delta):
     # type: (iotshadow.ShadowDeltaUpdatedEvent) -> None
+    prop = shadow_property
     try:
-        print("Received shadow delta event.")
-        if delta.state and (shadow_property in delta.state):
-            value = delta.state[shadow_property]
+        logger.info("Received shadow delta event.")
+        if delta.state and (prop in delta.state):
+            value = delta.state[prop]
             if value is None:
-                print("  Delta reports that '{}' was deleted. Resetting defaults...".format(shadow_property))
-                change_shadow_value(SHADOW_VALUE_DEFAULT)
+                logger.info("  Delta reports that '%s' was deleted. Resetting defaults...", prop)
+                change_shadow_value("default", SHADOW_VALUE_DEFAULT)
                 return
             else:
-                print("  Delta reports that desired value is '{}'. Changing local value...".format(value))
-                change_shadow_value(value)
+                logger.info("  Delta reports that desired value is '%s'. Changing local value...", value)
+                change_shadow_value("delta", value)
         else:
-            print("  Delta did not report a change in '{}'".format(shadow_property))
+            logger.info("  Delta did not report a change in '%s'", prop)
 
     except Exception as e:
         exit(e)
 
-def on_publish_update_shadow(future):
-    #type: (Future) -> None
-    try:
-        future.result()
-        print("Update request published.")
-    except Exception as e:
-        print("Failed to publish update request.")
-        exit(e)
-
 def on_update_shadow_accepted(response):
     # type: (iotshadow.UpdateShadowResponse) -> None
     try:
-        print("Finished updating reported shadow value to '{}'.".format(response.state.reported[shadow_property])) # type: ignore
-        print("Enter desired value: ") # remind user they can input new values
+        logger.info("Finished updating reported shadow value to '%s'.", response.state.reported[shadow_property]) # type: ignore
+        logger.info("Enter desired value: ") # remind user they can input new values
     except:
         exit("Updated shadow is missing the target property.")
 
 def on_update_shadow_rejected(error):
     # type: (iotshadow.ErrorResponse) -> None
-    exit("Update request was rejected. code:{} message:'{}'".format(
-        error.code, error.message))
+    exit(f"Update request was rejected. code:{error.code} message:'{error.message}'")
+
+def change_shadow_value(source, value, is_initial_query=False):
+    # source is one of:
+    #   "reported": value is already reported by the server, just adopt it locally
+    #   "delta":    the server already holds this "desired" value, only "reported" needs updating
+    #   "user":     a local change, which overrides whatever "desired" value the server holds
+    #   "default":  the property is missing from the server, set both "reported" and "desired"
+    #
+    # String values are interned, so when a value repeats, the writer's
+    # equality check short-circuits on identity instead of comparing characters.
+    if isinstance(value, str):
+        value = sys.intern(value)
+    shadow_updates.put((source, value, is_initial_query))
+
+def flush_shadow_updates():
+    # Returns once the writer has published whatever is waiting in the
+    # coalescing window
+    flushed = threading.Event()
+    shadow_updates.put(("flush", flushed, False))
+    flushed.wait()
+
+def shadow_writer_thread_fn():
+    # Only this thread reads or writes these
+    shadow_value = None
+    last_published = None
 
-def set_local_value_due_to_initial_query(reported_value):
-    with locked_data.lock:
-        locked_data.shadow_value = reported_value
-    print("Enter desired value: ") # remind user they can input new values
+    while True:
+        flushed = None
+        try:
+            update_desired = False
+            source, value, is_initial_query = shadow_updates.get()
+
+            # The window opens with the first change, so a steady stream of
+            # changes still publishes at least once per window.
+            deadline = time.monotonic() + UPDATE_COALESCE_SECS
+            while True:
+                if source == "flush":
+                    # Close the window early, publishing what it has so far
+                    flushed = value
+                    break
+                elif is_initial_query and shadow_value is not None:
+                    logger.info("  Ignoring initial query because a delta event has already been received.")
+                elif source == "reported":
+                    shadow_value = last_published = value
+                elif shadow_value == value:
+                    logger.info("Local value is already '%s'.", value)
+                else:
+                    logger.info("Changed local shadow value to '%s'.", value)
+                    shadow_value = value
+                    update_desired = update_desired or source != "delta"
+
+                # Changes arriving within the coalescing window are folded into
+                # this update, so only the latest value is published.
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    source, value, is_initial_query = shadow_updates.get(timeout=remaining)
+                except queue.Empty:
+                    break
+
+            if shadow_value != last_published:
+                last_published = shadow_value
+                logger.info("Updating reported shadow value to '%s'...", shadow_value)
+                # The shadow service reports the outcome on update/accepted or
+                # update/rejected, so the publish future itself isn't needed.
+                fast_publish_update(build_update_payload(shadow_value, update_desired))
+            elif not flushed:
+                # Nothing changed on the server, so no update/accepted response
+                # will prompt the user. This covers an adopted "reported" value,
+                # a repeated value, and a burst ending back at the published value.
+                logger.info("Enter desired value: ") # remind user they can input new values
 
-def change_shadow_value(value):
-    with locked_data.lock:
-        if locked_data.shadow_value == value:
-            print("Local value is already '{}'.".format(value))
-            print("Enter desired value: ") # remind user they can input new values
-            return
-
-        print("Changed local shadow value to '{}'.".format(value))
-        locked_data.shadow_value = value
-
-    print("Updating reported shadow value to '{}'...".format(value))
-    request = iotshadow.UpdateShadowRequest(
-        thing_name=thing_name,
-        state=iotshadow.ShadowState(
-            reported={ shadow_property: value },
-            desired={ shadow_property: value },
-        )
-    )
-    future = shadow_client.publish_update_shadow(request, mqtt.QoS.AT_LEAST_ONCE)
-    future.add_done_callback(on_publish_update_shadow)
+        except Exception as e:
+            exit(e)
+
+        if flushed:
+            flushed.set()
+
+def build_update_payload(value, update_desired, _dumps=json.dumps):
+    # json.dumps is bound as a default above, making it a local lookup
+    # instead of a global + attribute lookup.
+
+    # json.dumps() escapes the value correctly whether it's a string typed by
+    # the user or any other JSON type received in a delta event.
+    value_json = _dumps(value).encode()
+    if update_desired:
+        return update_payload_prefix + value_json + update_payload_desired_infix + value_json + update_payload_suffix
+    return update_payload_prefix + value_json + update_payload_suffix
+
+def fast_publish_update(payload, _qos=mqtt.QoS.AT_MOST_ONCE):
+    # Publish on the connection directly to the precomputed topic, skipping the
+    # per-call request objects, topic formatting, and JSON encoding done by
+    # shadow_client.publish_update_shadow().
+    # QoS 0 is enough, the shadow service already responds on update/accepted
+    # or update/rejected, so waiting for a PUBACK adds nothing.
+    future, _ = mqtt_connection.publish(
+        topic=update_topic,
+        payload=payload,
+        qos=_qos)
+    return future
+
+def handle_user_input(new_value):
+    # If user wants to quit sample, then quit.
+    # Otherwise change the shadow value.
+    # Returns whether to keep reading user input.
+    if new_value in QUIT_COMMANDS:
+        exit("User has quit")
+        return False
+
+    change_shadow_value("user", new_value)
+    return True
+
+def on_user_input_ready(selector):
+    try:
+        # Read whatever is available without blocking, and handle each complete line
+        data = os.read(sys.stdin.fileno(), 4096)
+        if not data:
+            raise EOFError("End of user input")
+
+        lines = (user_input_buffer[0] + data).split(b'\n')
+        user_input_buffer[0] = lines.pop()
+        for line in lines:
+            if not handle_user_input(line.decode().rstrip('\r')):
+                selector.unregister(sys.stdin)
+                return
+
+    except Exception as e:
+        logger.error("Exception reading user input.")
+        selector.unregister(sys.stdin)
+        exit(e)
 
 def user_input_thread_fn():
+    # Only used where stdin can't be polled with the selectors module,
+    # i.e. on Windows, or when stdin is a file the selector refuses
     while True:
         try:
             # Read user input
-            new_value = input()
-
-            # If user wants to quit sample, then quit.
-            # Otherwise change the shadow value.
-            if new_value in ['exit', 'quit']:
-                exit("User has quit")
+            if not handle_user_input(input()):
                 break
-            else:
-                change_shadow_value(new_value)
 
         except Exception as e:
-            print("Exception on input thread.")
+            logger.error("Exception on input thread.")
             exit(e)
             break
 
@@ -224,121 +374,190 @@ if __name__ == '__main__':
     # Process input args
     args = parser.parse_args()
     thing_name = args.thing_name
-    shadow_property = args.shadow_property
+    # Interned, so dict lookups of the property short-circuit on identity
+    shadow_property = sys.intern(args.shadow_property)
+    update_topic = f'$aws/things/{thing_name}/shadow/update'
+    shadow_property_json = json.dumps(shadow_property).encode()
+    update_payload_prefix = b'{"state":{"reported":{' + shadow_property_json + b':'
+    update_payload_desired_infix = b'},"desired":{' + shadow_property_json + b':'
+    update_payload_suffix = b'}}}'
     io.init_logging(getattr(io.LogLevel, args.verbosity), 'stderr')
+    log_listener.start()
 
-    # Spin up resources
-    event_loop_group = io.EventLoopGroup(1)
-    host_resolver = io.DefaultHostResolver(event_loop_group)
-    client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
-
-    if args.use_websocket == True:
-        proxy_options = None
-        if (args.proxy_host):
-            proxy_options = http.HttpProxyOptions(host_name=args.proxy_host, port=args.proxy_port)
-
-        credentials_provider = auth.AwsCredentialsProvider.new_default_chain(client_bootstrap)
-        mqtt_connection = mqtt_connection_builder.websockets_with_default_aws_signing(
-            endpoint=args.endpoint,
-            client_bootstrap=client_bootstrap,
-            region=args.signing_region,
-            credentials_provider=credentials_provider,
-            websocket_proxy_options=proxy_options,
-            ca_filepath=args.root_ca,
-            client_id=args.client_id,
-            clean_session=False,
-            keep_alive_secs=6)
+    try:
+        # Spin up resources
+        event_loop_group = io.EventLoopGroup(1)
+        host_resolver = io.DefaultHostResolver(event_loop_group)
+        client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
+
+        if args.use_websocket == True:
+            proxy_options = None
+            if (args.proxy_host):
+                proxy_options = http.HttpProxyOptions(host_name=args.proxy_host, port=args.proxy_port)
+
+            credentials_provider = auth.AwsCredentialsProvider.new_default_chain(client_bootstrap)
+            mqtt_connection = mqtt_connection_builder.websockets_with_default_aws_signing(
+                endpoint=args.endpoint,
+                client_bootstrap=client_bootstrap,
+                region=args.signing_region,
+                credentials_provider=credentials_provider,
+                websocket_proxy_options=proxy_options,
+                ca_filepath=args.root_ca,
+                client_id=args.client_id,
+                on_connection_interrupted=on_connection_interrupted,
+                on_connection_resumed=on_connection_resumed,
+                clean_session=False,
+                keep_alive_secs=KEEP_ALIVE_SECS)
 
-    else:
-        mqtt_connection = mqtt_connection_builder.mtls_from_path(
-            endpoint=args.endpoint,
-            cert_filepath=args.cert,
-            pri_key_filepath=args.key,
-            client_bootstrap=client_bootstrap,
-            ca_filepath=args.root_ca,
-            client_id=args.client_id,
-            clean_session=False,
-            keep_alive_secs=6)
-
-    print("Connecting to {} with client ID '{}'...".format(
-        args.endpoint, args.client_id))
-
-    connected_future = mqtt_connection.connect()
-
-    shadow_client = iotshadow.IotShadowClient(mqtt_connection)
-
-    # Wait for connection to be fully established.
-    # Note that it's not necessary to wait, commands issued to the
-    # mqtt_connection before its fully connected will simply be queued.
-    # But this sample waits here so it's obvious when a connection
-    # fails or succeeds.
-    connected_future.result()
-    print("Connected!")
+        else:
+            mqtt_connection = mqtt_connection_builder.mtls_from_path(
+                endpoint=args.endpoint,
+                cert_filepath=args.cert,
+                pri_key_filepath=args.key,
+                client_bootstrap=client_bootstrap,
+                ca_filepath=args.root_ca,
+                client_id=args.client_id,
+                on_connection_interrupted=on_connection_interrupted,
+                on_connection_resumed=on_connection_resumed,
+                clean_session=False,
+                keep_alive_secs=KEEP_ALIVE_SECS)
+
+        logger.info("Connecting to %s with client ID '%s'...", args.endpoint, args.client_id)
+
+        mqtt_connection.connect().add_done_callback(on_connected)
+
+        shadow_client = iotshadow.IotShadowClient(mqtt_connection)
+
+        # Wait for connection to be fully established.
+        # Note that it's not necessary to wait, commands issued to the
+        # mqtt_connection before its fully connected will simply be queued.
+        # But this sample waits here so it's obvious when a connection
+        # fails or succeeds.
+        connected_event.wait()
+        if connection_error[0]:
+            raise connection_error[0]
+        logger.info("Connected!")
 
-    try:
-        # Subscribe to necessary topics.
-        # Note that is **is** important to wait for "accepted/rejected" subscriptions
-        # to succeed before publishing the corresponding "request".
-        print("Subscribing to Delta events...")
-        delta_subscribed_future, _ = shadow_client.subscribe_to_shadow_delta_updated_events(
-            request=iotshadow.ShadowDeltaUpdatedSubscriptionRequest(thing_name=args.thing_name),
-            qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=on_shadow_delta_updated)
-
-        # Wait for subscription to succeed
-        delta_subscribed_future.result()
-
-        print("Subscribing to Update responses...")
-        update_accepted_subscribed_future, _ = shadow_client.subscribe_to_update_shadow_accepted(
-            request=iotshadow.UpdateShadowSubscriptionRequest(thing_name=args.thing_name),
-            qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=on_update_shadow_accepted)
-
-        update_rejected_subscribed_future, _ = shadow_client.subscribe_to_update_shadow_rejected(
-            request=iotshadow.UpdateShadowSubscriptionRequest(thing_name=args.thing_name),
-            qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=on_update_shadow_rejected)
-
-        # Wait for subscriptions to succeed
-        update_accepted_subscribed_future.result()
-        update_rejected_subscribed_future.result()
-
-        print("Subscribing to Get responses...")
-        get_accepted_subscribed_future, _ = shadow_client.subscribe_to_get_shadow_accepted(
-            request=iotshadow.GetShadowSubscriptionRequest(thing_name=args.thing_name),
-            qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=on_get_shadow_accepted)
-
-        get_rejected_subscribed_future, _ = shadow_client.subscribe_to_get_shadow_rejected(
-            request=iotshadow.GetShadowSubscriptionRequest(thing_name=args.thing_name),
-            qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=on_get_shadow_rejected)
-
-        # Wait for subscriptions to succeed
-        get_accepted_subscribed_future.result()
-        get_rejected_subscribed_future.result()
-
-        # The rest of the sample runs asyncronously.
-
-        # Issue request for shadow's current state.
-        # The response will be received by the on_get_accepted() callback
-        print("Requesting current shadow state...")
-        publish_get_future = shadow_client.publish_get_shadow(
-            request=iotshadow.GetShadowRequest(thing_name=args.thing_name),
-            qos=mqtt.QoS.AT_LEAST_ONCE)
-
-        # Ensure that publish succeeds
-        publish_get_future.result()
-
-        # Launch thread to handle user input.
         # A "daemon" thread won't prevent the program from shutting down.
-        print("Launching thread to read user input...")
-        user_input_thread = threading.Thread(target=user_input_thread_fn, name='user_input_thread')
-        user_input_thread.daemon = True
-        user_input_thread.start()
+        shadow_writer_thread = threading.Thread(target=shadow_writer_thread_fn, name='shadow_writer_thread')
+        shadow_writer_thread.daemon = True
+        shadow_writer_thread.start()
 
-    except Exception as e:
-        exit(e)
+        try:
+            # Subscribe to necessary topics.
+            # Note that is **is** important to wait for "accepted/rejected" subscriptions
+            # to succeed before publishing the corresponding "request".
+            # Requests for the same thing are built once and shared by the
+            # accepted and rejected subscriptions.
+            update_subscription_request = iotshadow.UpdateShadowSubscriptionRequest(thing_name=thing_name)
+            get_subscription_request = iotshadow.GetShadowSubscriptionRequest(thing_name=thing_name)
+
+            # All subscriptions are issued up front so their acknowledgements
+            # arrive in parallel, rather than waiting a round-trip for each one.
+            logger.info("Subscribing to Delta events...")
+            delta_subscribed_future, _ = shadow_client.subscribe_to_shadow_delta_updated_events(
+                request=iotshadow.ShadowDeltaUpdatedSubscriptionRequest(thing_name=thing_name),
+                qos=mqtt.QoS.AT_LEAST_ONCE,
+                callback=on_shadow_delta_updated)
+
+            logger.info("Subscribing to Update responses...")
+            update_accepted_subscribed_future, _ = shadow_client.subscribe_to_update_shadow_accepted(
+                request=update_subscription_request,
+                qos=mqtt.QoS.AT_LEAST_ONCE,
+                callback=on_update_shadow_accepted)
+
+            update_rejected_subscribed_future, _ = shadow_client.subscribe_to_update_shadow_rejected(
+                request=update_subscription_request,
+                qos=mqtt.QoS.AT_LEAST_ONCE,
+                callback=on_update_shadow_rejected)
+
+            logger.info("Subscribing to Get responses...")
+            get_accepted_subscribed_future, _ = shadow_client.subscribe_to_get_shadow_accepted(
+                request=get_subscription_request,
+                qos=mqtt.QoS.AT_LEAST_ONCE,
+                callback=on_get_shadow_accepted)
+
+            get_rejected_subscribed_future, _ = shadow_client.subscribe_to_get_shadow_rejected(
+                request=get_subscription_request,
+                qos=mqtt.QoS.AT_LEAST_ONCE,
+                callback=on_get_shadow_rejected)
+
+            # Only the "get" subscriptions must succeed before requesting the
+            # shadow document, so don't hold that request up behind the others.
+            get_subscribed_futures = [
+                get_accepted_subscribed_future,
+                get_rejected_subscribed_future,
+            ]
+            futures.wait(get_subscribed_futures, return_when=futures.ALL_COMPLETED)
+            for subscribed_future in get_subscribed_futures:
+                subscribed_future.result()
+
+            # The rest of the sample runs asyncronously.
+
+            # Issue request for shadow's current state.
+            # The response will be received by the on_get_accepted() callback,
+            # which acknowledges the request, so QoS 0 is used for the publish.
+            logger.info("Requesting current shadow state...")
+            publish_get_future = shadow_client.publish_get_shadow(
+                request=iotshadow.GetShadowRequest(thing_name=thing_name),
+                qos=mqtt.QoS.AT_MOST_ONCE)
+
+            # Wait for the remaining subscriptions, and ensure that publish succeeds
+            remaining_futures = [
+                delta_subscribed_future,
+                update_accepted_subscribed_future,
+                update_rejected_subscribed_future,
+                publish_get_future,
+            ]
+            futures.wait(remaining_futures, return_when=futures.ALL_COMPLETED)
+            for remaining_future in remaining_futures:
+                remaining_future.result()
+
+            # The main thread acts as the sample's event loop, dispatching
+            # to the callback registered alongside each file object.
+            event_loop_selector = selectors.DefaultSelector()
+
+            # Lets exit() wake the event loop, so it can block without a timeout
+            wake_receiver, wake_socket = socket.socketpair()
+            event_loop_selector.register(wake_receiver, selectors.EVENT_READ)
+
+            # Reading stdin on the event loop avoids dedicating a thread to it
+            stdin_registered = False
+            if sys.platform != 'win32':
+                try:
+                    event_loop_selector.register(sys.stdin, selectors.EVENT_READ, on_user_input_ready)
+                    stdin_registered = True
+                except (OSError, ValueError):
+                    # Some selectors refuse certain file types, e.g. epoll fails
+                    # with EPERM when stdin is redirected from a regular file.
+                    pass
+
+            if not stdin_registered:
+                # Launch thread to handle user input.
+                # A "daemon" thread won't prevent the program from shutting down.
+                logger.info("Launching thread to read user input...")
+                user_input_thread = threading.Thread(target=user_input_thread_fn, name='user_input_thread')
+                user_input_thread.daemon = True
+                user_input_thread.start()
+
+        except Exception as e:
+            exit(e)
+
+        # Run until exit() is called (user types 'quit', or an error occurs)
+        while not locked_data.exit_requested:
+            for key, _ in event_loop_selector.select():
+                if key.data:
+                    key.data(event_loop_selector)
+
+        # Don't lose the latest change to the coalescing window
+        flush_shadow_updates()
+
+        # Wait for the sample to finish. The disconnect future is completed
+        # directly by the CRT once the connection has closed.
+        logger.info("Disconnecting...")
+        mqtt_connection.disconnect().result()
+        logger.info("Disconnected.")
 
-    # Wait for the sample to finish (user types 'quit', or an error occurs)
-    is_sample_done.wait()
+    finally:
+        # Flush any output still in the queue, however the sample ends
+        log_listener.stop()